@@ -0,0 +1,270 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+
+class DiskCache:
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+
+        # key -> (size, metadata), ordered from least to most recently used
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+        # key -> threading.Event for every key that is currently being fetched
+        self._inflight = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, key):
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(key.encode("utf8")).hexdigest(),
+        )
+
+    def _load(self):
+        # Pick back up anything a previous process left behind, oldest first
+        # so that the least recently used entries are evicted first.
+        found = []
+        for filename in os.listdir(self.directory):
+            # Clean up after any fetch that never finished
+            if filename.endswith((".tmp", ".tmp.json")):
+                os.unlink(os.path.join(self.directory, filename))
+                continue
+
+            if not filename.endswith(".json"):
+                continue
+
+            path = os.path.join(self.directory, filename[:-5])
+            try:
+                with open(path + ".json", "r", encoding="utf8") as fp:
+                    entry = json.load(fp)
+                stat = os.stat(path)
+            except (OSError, ValueError):
+                continue
+
+            found.append((stat.st_mtime, entry["key"], stat.st_size, entry))
+
+        for _, key, size, entry in sorted(found, key=lambda e: e[0]):
+            self._entries[key] = (size, entry["metadata"])
+            self._size += size
+
+        self._evict()
+
+    def _evict(self):
+        # Must be called while holding self._lock (or during __init__)
+        while self._size > self.max_size and self._entries:
+            key, (size, _) = self._entries.popitem(last=False)
+            self._size -= size
+
+            for path in [self._path(key), self._path(key) + ".json"]:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def _open(self, key):
+        # Must be called while holding self._lock
+        _, metadata = self._entries[key]
+        try:
+            fp = open(self._path(key), "rb")
+        except FileNotFoundError:
+            # Something else removed our file out from underneath us, so
+            # treat this as a miss.
+            size, _ = self._entries.pop(key)
+            self._size -= size
+            return
+
+        # Keep the modification time up to date so that the order we evict in
+        # survives a restart.
+        os.utime(self._path(key))
+        self._entries.move_to_end(key)
+
+        return fp, metadata
+
+    def get(self, key, fetch):
+        # Returns an open file and the metadata for key, calling
+        # fetch(fp) -> metadata to fill in the cache on a miss. Only one
+        # caller will fetch any given key at a time, everyone else waits for
+        # that fetch to finish and then shares the result.
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    found = self._open(key)
+                    if found is not None:
+                        return found
+
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+
+            event.wait()
+
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with open(fd, "wb") as fp:
+                    metadata = fetch(fp)
+
+                with open(tmppath + ".json", "w", encoding="utf8") as fp:
+                    json.dump({"key": key, "metadata": metadata}, fp)
+
+                size = os.path.getsize(tmppath)
+                os.replace(tmppath, self._path(key))
+                os.replace(tmppath + ".json", self._path(key) + ".json")
+            except BaseException:
+                for path in [tmppath, tmppath + ".json"]:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                raise
+
+            with self._lock:
+                if key in self._entries:
+                    self._size -= self._entries.pop(key)[0]
+
+                self._entries[key] = (size, metadata)
+                self._size += size
+
+                # Open our file before evicting anything so that we can still
+                # serve it even if it is too large to stay in the cache.
+                fp = open(self._path(key), "rb")
+                self._evict()
+
+                return fp, metadata
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+
+def _tree_size(path):
+    size = 0
+    for dirname, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirname, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class TreeCache:
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+
+        # name -> size, ordered from least to most recently used
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+        # name -> number of callers currently using that tree, these trees
+        # will not be evicted until they have all finished with it.
+        self._pins = {}
+
+        # name -> threading.Lock, so only one caller at a time uses any tree
+        self._locks = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _name(self, key):
+        return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    def _load(self):
+        # Pick back up any trees a previous process left behind, oldest first
+        # so that the least recently used trees are evicted first.
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(path):
+                continue
+
+            found.append((os.stat(path).st_mtime, name, _tree_size(path)))
+
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._size += size
+
+        self._evict()
+
+    def _evict(self):
+        # Must be called while holding self._lock (or during __init__)
+        for name in list(self._entries):
+            if self._size <= self.max_size:
+                break
+
+            if self._pins.get(name):
+                continue
+
+            self._size -= self._entries.pop(name)
+            self._locks.pop(name, None)
+            shutil.rmtree(
+                os.path.join(self.directory, name),
+                ignore_errors=True,
+            )
+
+    @contextlib.contextmanager
+    def tree(self, key):
+        # Yields a directory for key that holds whatever was written into it
+        # the last time, if it hasn't been evicted since.
+        name = self._name(key)
+        path = os.path.join(self.directory, name)
+
+        with self._lock:
+            self._pins[name] = self._pins.get(name, 0) + 1
+            lock = self._locks.setdefault(name, threading.Lock())
+
+        size = None
+        try:
+            with lock:
+                os.makedirs(path, exist_ok=True)
+
+                # Keep the modification time up to date so that the order we
+                # evict in survives a restart.
+                os.utime(path)
+
+                try:
+                    yield path
+                finally:
+                    size = _tree_size(path)
+        finally:
+            with self._lock:
+                self._pins[name] -= 1
+                if not self._pins[name]:
+                    del self._pins[name]
+
+                if size is not None:
+                    self._size += size - self._entries.pop(name, 0)
+                    self._entries[name] = size
+
+                self._evict()
@@ -0,0 +1,146 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import lzma
+import zlib
+
+
+# Everything that decompressing corrupt data with one of our codecs can raise
+DECOMPRESSION_ERRORS = (EOFError, lzma.LZMAError, zlib.error)
+
+
+class _Identity:
+
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+class _LZMADecompressor:
+
+    def __init__(self):
+        self._decompressor = lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+class Codec:
+
+    def __init__(self, name, extension, compressor, decompressor):
+        self.name = name
+        self.extension = extension
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+    def compress(self, data):
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def compress_chunks(self, iterable):
+        compressor = self.compressor()
+        for chunk in iterable:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self.decompressor()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def decompress_chunks(self, iterable):
+        decompressor = self.decompressor()
+        for chunk in iterable:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+        yield decompressor.flush()
+
+
+def _xz(level):
+    return Codec(
+        "xz",
+        ".xz",
+        lambda: lzma.LZMACompressor(
+            preset=level if level is not None else lzma.PRESET_DEFAULT,
+        ),
+        _LZMADecompressor,
+    )
+
+
+def _gzip(level):
+    level = level if level is not None else zlib.Z_DEFAULT_COMPRESSION
+    return Codec(
+        "gzip",
+        ".gz",
+        lambda: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+        lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    )
+
+
+def _zlib(level):
+    level = level if level is not None else zlib.Z_DEFAULT_COMPRESSION
+    return Codec(
+        "zlib",
+        ".zz",
+        lambda: zlib.compressobj(level),
+        zlib.decompressobj,
+    )
+
+
+def _none(level):
+    return Codec("none", ".raw", _Identity, _Identity)
+
+
+_CODECS = {
+    "xz": _xz,
+    "gzip": _gzip,
+    "zlib": _zlib,
+    "none": _none,
+}
+
+
+def get_codec(name, level=None):
+    try:
+        factory = _CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown codec '{}'".format(name)) from None
+
+    return factory(int(level) if level is not None else None)
+
+
+def from_config(config):
+    return get_codec(config.get("CODEC", "xz"), config.get("CODEC_LEVEL"))
+
+
+def from_name(name):
+    # Find the codec that an object was stored with using its extension,
+    # the compression level doesn't matter for reading it back.
+    for codec in [factory(None) for factory in _CODECS.values()]:
+        if name.endswith(codec.extension):
+            return codec
+
+    raise ValueError("Unknown codec for '{}'".format(name))
+
+
+def strip_extension(name):
+    return name[:-len(from_name(name).extension)]
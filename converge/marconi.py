@@ -11,19 +11,69 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import calendar
+import datetime
 import json
+import re
+import threading
+import time
 import urllib.parse
 
 import requests
+import requests.adapters
 
 CLIENT_ID = "20af609a-4a6f-45aa-a9b0-d7946274dc52"
 
+# The most messages the API will let us claim or delete in a single request
+MAX_MESSAGES = 20
+
+# How long before a token actually expires we consider it stale and fetch a
+# new one, this keeps us from sending a token that expires while in flight.
+TOKEN_REFRESH_MARGIN = 300
+
+# How long we'll wait on the identity API, every queue call in the process
+# waits behind a token refresh so it can't be allowed to hang.
+AUTH_TIMEOUT = 30
+
+_EXPIRES_RE = re.compile(
+    r"^(?P<timestamp>\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?"
+    r"(?:(?P<utc>Z)|(?P<sign>[+-])(?P<hours>\d{2}):?(?P<minutes>\d{2}))?$"
+)
+
+# Process wide cache of (user, key) -> (token, expires)
+_tokens = {}
+_tokens_lock = threading.Lock()
+
 
 class QueueException(Exception):
     pass
 
 
-def _get_auth_token(user, key):
+def _parse_expires(value):
+    # Turn the ISO 8601 expires value from the identity API into a UTC
+    # timestamp
+    match = _EXPIRES_RE.match(value)
+    if match is None:
+        raise ValueError("Invalid expires value '{}'".format(value))
+
+    expires = calendar.timegm(
+        datetime.datetime.strptime(
+            match.group("timestamp"),
+            "%Y-%m-%dT%H:%M:%S",
+        ).timetuple()
+    )
+
+    # Adjust for any offset from UTC
+    if match.group("sign") is not None:
+        offset = (
+            int(match.group("hours")) * 3600 + int(match.group("minutes")) * 60
+        )
+        expires += -offset if match.group("sign") == "+" else offset
+
+    return expires
+
+
+def _authenticate(user, key):
     # Get the auth token
     resp = requests.post(
         "https://identity.api.rackspacecloud.com/v2.0/tokens",
@@ -37,90 +87,207 @@ def _get_auth_token(user, key):
         }),
         headers={
             "Content-Type": "application/json",
-        }
+        },
+        timeout=AUTH_TIMEOUT,
     )
     resp.raise_for_status()
-    return resp.json()["access"]["token"]["id"]
 
+    token = resp.json()["access"]["token"]
+    return token["id"], _parse_expires(token["expires"])
 
-def push(user, key, queue, message, ttl=1209600, retries=20, region="iad"):
-    # Send message to queue
-    for _ in range(retries):
-        resp = requests.post(
-            (
-                "https://{}.queues.api.rackspacecloud.com/v1/queues/{}/"
-                "messages".format(region, queue)
-            ),
-            data=json.dumps([{"ttl": ttl, "body": message}]),
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "X-Auth-Token": _get_auth_token(user, key),
-                "Client-ID": CLIENT_ID,
-            }
-        )
-        resp.raise_for_status()
 
-        if not resp.json()["partial"]:
-            return
-    else:
-        raise QueueException("Cannot Queue Message")
+def _get_auth_token(user, key):
+    with _tokens_lock:
+        # Reuse our cached token as long as it isn't about to expire
+        cached = _tokens.get((user, key))
+        if cached is not None:
+            token, expires = cached
+            if expires - TOKEN_REFRESH_MARGIN > time.time():
+                return token
 
+        token, expires = _authenticate(user, key)
+        _tokens[(user, key)] = (token, expires)
 
-def claim(user, key, queue, ttl=300, grace=300, region="iad"):
-    resp = requests.post(
-        (
-            "https://{}.queues.api.rackspacecloud.com/v1/queues/{}/"
-            "claims?limit=1".format(region, queue)
-        ),
-        data=json.dumps({"ttl": ttl, "grace": grace}),
-        headers={
+        return token
+
+
+def _invalidate_auth_token(user, key, token):
+    with _tokens_lock:
+        # Only throw away the cached token if it is the one that was rejected,
+        # another thread may have already replaced it with a fresh one.
+        cached = _tokens.get((user, key))
+        if cached is not None and cached[0] == token:
+            del _tokens[(user, key)]
+
+
+class QueueClient:
+
+    def __init__(self, user, key, region="iad", pool_connections=1,
+                 pool_maxsize=10):
+        self.user = user
+        self.key = key
+        self.region = region
+        self.base_url = "https://{}.queues.api.rackspacecloud.com/".format(
+            region,
+        )
+
+        # Keep a persistent session around so that we reuse our connections
+        # to the queue API instead of doing a new handshake for every call.
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+            ),
+        )
+        self.session.headers.update({
             "Content-Type": "application/json",
             "Accept": "application/json",
-            "X-Auth-Token": _get_auth_token(user, key),
+            "Connection": "keep-alive",
             "Client-ID": CLIENT_ID,
-        }
-    )
-    resp.raise_for_status()
+        })
 
-    # Check if we got any items returned
-    if resp.status_code == 204:
-        return
+    def _request(self, method, path, **kwargs):
+        url = urllib.parse.urljoin(self.base_url, path)
 
-    # Insert the claim location into the data too
-    data = resp.json()[0]
-    data["claim"] = resp.headers["Location"]
+        for attempt in range(2):
+            token = _get_auth_token(self.user, self.key)
 
-    return data
+            resp = self.session.request(
+                method,
+                url,
+                headers={"X-Auth-Token": token},
+                **kwargs
+            )
 
+            # If our token was rejected, it has been revoked or expired early
+            # so throw it away and try one more time with a fresh one.
+            if resp.status_code == 401 and not attempt:
+                _invalidate_auth_token(self.user, self.key, token)
+                continue
 
-def unclaim(user, key, queue, task, region="iad"):
-    resp = requests.delete(
-        urllib.parse.urljoin(
-            "https://{}.queues.api.rackspacecloud.com/".format(region),
+            return resp
+
+    def close(self):
+        self.session.close()
+
+    def push(self, queue, message, ttl=1209600, retries=20):
+        # Send message to queue
+        for _ in range(retries):
+            resp = self._request(
+                "POST",
+                "v1/queues/{}/messages".format(queue),
+                data=json.dumps([{"ttl": ttl, "body": message}]),
+            )
+            resp.raise_for_status()
+
+            if not resp.json()["partial"]:
+                return
+        else:
+            raise QueueException("Cannot Queue Message")
+
+    def claim(self, queue, ttl=300, grace=300, limit=1):
+        resp = self._request(
+            "POST",
+            "v1/queues/{}/claims?limit={}".format(
+                queue,
+                min(limit, MAX_MESSAGES),
+            ),
+            data=json.dumps({"ttl": ttl, "grace": grace}),
+        )
+        resp.raise_for_status()
+
+        # Check if we got any items returned
+        if resp.status_code == 204:
+            return []
+
+        # Insert the claim location into the data too
+        messages = resp.json()
+        for message in messages:
+            message["claim"] = resp.headers["Location"]
+
+        return messages
+
+    def renew(self, queue, task, ttl=300, grace=300):
+        resp = self._request(
+            "PATCH",
             task["claim"],
-        ),
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "X-Auth-Token": _get_auth_token(user, key),
-            "Client-ID": CLIENT_ID,
-        }
+            data=json.dumps({"ttl": ttl, "grace": grace}),
+        )
+        resp.raise_for_status()
+
+    def unclaim(self, queue, task):
+        resp = self._request("DELETE", task["claim"])
+        resp.raise_for_status()
+
+    def delete(self, queue, task):
+        resp = self._request("DELETE", task["href"])
+        resp.raise_for_status()
+
+    def delete_many(self, queue, tasks):
+        ids = [
+            urllib.parse.urlparse(task["href"]).path.rsplit("/", 1)[-1]
+            for task in tasks
+        ]
+
+        # The API limits how many messages can be deleted in one request
+        for i in range(0, len(ids), MAX_MESSAGES):
+            resp = self._request(
+                "DELETE",
+                "v1/queues/{}/messages?ids={}".format(
+                    queue,
+                    ",".join(ids[i:i + MAX_MESSAGES]),
+                ),
+            )
+            resp.raise_for_status()
+
+
+# Shared clients keyed by (user, key, region) so that everything in this
+# process reuses the same connection pools.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(user, key, region="iad"):
+    with _clients_lock:
+        client = _clients.get((user, key, region))
+        if client is None:
+            client = QueueClient(user, key, region=region)
+            _clients[(user, key, region)] = client
+
+        return client
+
+
+def push(user, key, queue, message, ttl=1209600, retries=20, region="iad"):
+    get_client(user, key, region).push(
+        queue,
+        message,
+        ttl=ttl,
+        retries=retries,
     )
-    resp.raise_for_status()
 
 
-def delete(user, key, queue, task, region="iad"):
-    resp = requests.delete(
-        urllib.parse.urljoin(
-            "https://{}.queues.api.rackspacecloud.com/".format(region),
-            task["href"],
-        ),
-        headers={
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "X-Auth-Token": _get_auth_token(user, key),
-            "Client-ID": CLIENT_ID,
-        }
+def claim(user, key, queue, ttl=300, grace=300, limit=1, region="iad"):
+    return get_client(user, key, region).claim(
+        queue,
+        ttl=ttl,
+        grace=grace,
+        limit=limit,
     )
-    resp.raise_for_status()
+
+
+def renew(user, key, queue, task, ttl=300, grace=300, region="iad"):
+    get_client(user, key, region).renew(queue, task, ttl=ttl, grace=grace)
+
+
+def unclaim(user, key, queue, task, region="iad"):
+    get_client(user, key, region).unclaim(queue, task)
+
+
+def delete(user, key, queue, task, region="iad"):
+    get_client(user, key, region).delete(queue, task)
+
+
+def delete_many(user, key, queue, tasks, region="iad"):
+    get_client(user, key, region).delete_many(queue, tasks)
@@ -0,0 +1,132 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import array
+import heapq
+import sys
+import threading
+
+from coverage import CoverageData
+
+from converge.utils import make_real_path
+
+
+def _unique(iterable):
+    # Drop the duplicates out of a sorted iterable
+    previous = object()
+    for item in iterable:
+        if item != previous:
+            yield item
+            previous = item
+
+
+def _pairs(flat):
+    return zip(flat[::2], flat[1::2])
+
+
+def _flatten(pairs):
+    for a, b in pairs:
+        yield a
+        yield b
+
+
+def _lines(numbers):
+    return array.array("i", sorted(set(map(int, numbers))))
+
+
+def _arcs(pairs):
+    return array.array(
+        "i",
+        _flatten(sorted({(int(a), int(b)) for a, b in pairs})),
+    )
+
+
+class CoverageAccumulator:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        # path -> sorted array of line numbers
+        self.lines = {}
+
+        # path -> sorted array of (from, to) arcs, flattened into one array
+        # of from1, to1, from2, to2, ...
+        self.arcs = {}
+
+    def add(self, data):
+        # Convert everything before taking the lock, so that other threads can
+        # keep merging while we do the expensive part.
+        lines = [
+            (sys.intern(path), _lines(numbers))
+            for path, numbers in data.get("lines", {}).items()
+        ]
+        arcs = [
+            (sys.intern(path), _arcs(pairs))
+            for path, pairs in data.get("arcs", {}).items()
+        ]
+
+        with self._lock:
+            for path, numbers in lines:
+                if path in self.lines:
+                    numbers = array.array(
+                        "i",
+                        _unique(heapq.merge(self.lines[path], numbers)),
+                    )
+                self.lines[path] = numbers
+
+            for path, pairs in arcs:
+                if path in self.arcs:
+                    pairs = array.array(
+                        "i",
+                        _flatten(
+                            _unique(
+                                heapq.merge(
+                                    _pairs(self.arcs[path]),
+                                    _pairs(pairs),
+                                ),
+                            ),
+                        ),
+                    )
+                self.arcs[path] = pairs
+
+    def paths(self):
+        with self._lock:
+            return set(self.lines) | set(self.arcs)
+
+    def dump(self):
+        # The same shape as the data we get from builds, so it can be loaded
+        # back with add()
+        return {
+            "lines": {
+                path: numbers.tolist() for path, numbers in self.lines.items()
+            },
+            "arcs": {
+                path: [list(pair) for pair in _pairs(pairs)]
+                for path, pairs in self.arcs.items()
+            },
+        }
+
+    def coverage_data(self, root):
+        # Only build the per line dictionaries that coverage wants once we're
+        # done merging everything.
+        cdata = CoverageData()
+        cdata.add_line_data({
+            make_real_path(root, path): dict.fromkeys(numbers)
+            for path, numbers in self.lines.items()
+        })
+        cdata.add_arc_data({
+            make_real_path(root, path): dict.fromkeys(_pairs(pairs))
+            for path, pairs in self.arcs.items()
+        })
+
+        return cdata
@@ -0,0 +1,301 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import os.path
+import re
+import tarfile
+import tempfile
+import threading
+
+from libcloud.storage.base import Object
+from libcloud.storage.types import ObjectDoesNotExistError
+
+from converge import compression
+from converge.storage import get_container, upload_bytes
+from converge.utils import make_real_path
+
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# Files that configure how a report is rendered, rather than being reported on
+CONFIG_FILES = {".coveragerc"}
+
+# Blobs that we know are already stored, so we don't have to ask again. This
+# only ever grows, so just hold onto the ones we've seen most recently.
+KNOWN_SIZE = 100000
+
+_known = collections.OrderedDict()
+_known_lock = threading.Lock()
+
+
+def _blob_name(codec, digest):
+    return "sources/{digest}{ext}".format(digest=digest, ext=codec.extension)
+
+
+def _manifest_name(revision):
+    return "manifests/{revision}.json".format(revision=revision)
+
+
+def _read(obj):
+    return b"".join(obj.as_stream())
+
+
+def _remember(name):
+    with _known_lock:
+        _known[name] = True
+        _known.move_to_end(name)
+
+        while len(_known) > KNOWN_SIZE:
+            _known.popitem(last=False)
+
+
+def _blob_exists(config, codec, digest):
+    name = _blob_name(codec, digest)
+
+    with _known_lock:
+        if name in _known:
+            _known.move_to_end(name)
+            return True
+
+    # Each thread has to use its own driver to talk to Cloud Files with
+    try:
+        get_container(config).get_object(name)
+    except ObjectDoesNotExistError:
+        return False
+
+    _remember(name)
+
+    return True
+
+
+def _upload_blob(config, codec, digest, file_data):
+    name = _blob_name(codec, digest)
+    upload_bytes(get_container(config), codec.compress(file_data), name)
+    _remember(name)
+
+
+def _pool(config):
+    return concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(config.get("FETCH_CONCURRENCY", 8)),
+    )
+
+
+def _existing_blobs(config, codec, digests):
+    # Ask about every blob at once instead of waiting on each one in turn
+    digests = set(digests)
+    with _pool(config) as pool:
+        exists = pool.map(
+            lambda d: _blob_exists(config, codec, d),
+            sorted(digests),
+        )
+        return {d for d, e in zip(sorted(digests), exists) if e}
+
+
+class MissingSourcesError(Exception):
+
+    def __init__(self, missing):
+        super().__init__("Missing source blobs: {}".format(", ".join(missing)))
+        self.missing = missing
+
+
+def _check_filename(filename):
+    # Source file names have to stay inside of the tree we write them into
+    path = os.path.normpath(filename)
+    if os.path.isabs(path) or path.split(os.sep)[0] in {os.curdir, os.pardir}:
+        raise ValueError("Invalid source file name '{}'".format(filename))
+
+
+def _check_digests(digests):
+    for digest in digests:
+        if not isinstance(digest, str) or not _DIGEST_RE.match(digest):
+            raise ValueError("Invalid source hash '{}'".format(digest))
+
+
+def missing_blobs(config, codec, digests):
+    _check_digests(digests)
+
+    return sorted(set(digests) - _existing_blobs(config, codec, digests))
+
+
+def has_sources(container, revision):
+    for name in [_manifest_name(revision),
+                 "files/{revision}.tar.xz".format(revision=revision)]:
+        try:
+            container.get_object(name)
+        except ObjectDoesNotExistError:
+            continue
+        else:
+            return True
+
+    return False
+
+
+def store_sources(config, codec, revision, source_files, manifest=None):
+    # Clients may send us just the hashes of files they know we already have
+    if not isinstance(manifest, (dict, type(None))):
+        raise ValueError("Invalid source manifest")
+    manifest = dict(manifest or {})
+    for filename in manifest:
+        _check_filename(filename)
+
+    # Store each file as a blob keyed by the hash of its contents, skipping
+    # any that an earlier revision has already stored.
+    blobs = {}
+    for filename, _, fileobj in source_files:
+        _check_filename(filename)
+
+        file_data = fileobj.read()
+        digest = hashlib.sha256(file_data).hexdigest()
+
+        blobs[digest] = file_data
+        manifest[filename] = digest
+
+    digests = set(manifest.values())
+    _check_digests(digests)
+    existing = _existing_blobs(config, codec, digests)
+
+    # Make sure we actually have every file that we were only sent a hash for
+    missing = sorted(digests - existing - set(blobs))
+    if missing:
+        raise MissingSourcesError(missing)
+
+    with _pool(config) as pool:
+        futures = [
+            pool.submit(_upload_blob, config, codec, digest, file_data)
+            for digest, file_data in blobs.items()
+            if digest not in existing
+        ]
+
+        # Raise any errors that happened while uploading
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    # The manifest goes last, so that if it exists every blob it points to
+    # does too.
+    upload_bytes(
+        get_container(config),
+        json.dumps(
+            {"codec": codec.name, "files": manifest},
+            sort_keys=True,
+        ).encode("utf8"),
+        _manifest_name(revision),
+    )
+
+    return manifest
+
+
+def _write(directory, filename, file_data):
+    path = make_real_path(directory, filename)
+
+    # Don't let a file name escape from the directory we're writing into
+    if not path.startswith(make_real_path(directory, "") + os.sep):
+        raise ValueError("Invalid source file name '{}'".format(filename))
+
+    # Write to a temporary file first, so that anything reusing this
+    # directory never sees a partially written file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with open(fd, "wb") as fp:
+            fp.write(file_data)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+def _wanted(directory, filename, filenames):
+    # Whether we still need to write filename into directory
+    if filenames is not None and os.path.normpath(filename) not in filenames:
+        return False
+
+    return not os.path.exists(make_real_path(directory, filename))
+
+
+def _fetch_blob(config, codec, directory, filename, digest):
+    # The manifest tells us the blob exists, so we can skip asking Cloud Files
+    # about it and go straight to downloading it.
+    container = get_container(config)
+    obj = Object(
+        _blob_name(codec, digest), None, None, {}, {}, container,
+        container.driver,
+    )
+
+    _write(directory, filename, codec.decompress(_read(obj)))
+
+
+def materialize(config, revision, directory, filenames=None):
+    # Only write out the files named in filenames (if given) that aren't
+    # already in directory, so that a directory can be reused between calls.
+    if filenames is not None:
+        filenames = {os.path.normpath(f) for f in filenames}
+
+        if not any(_wanted(directory, f, filenames) for f in filenames):
+            return
+
+        # We're going to the manifest anyway, so bring along any config too
+        filenames |= CONFIG_FILES
+
+    container = get_container(config)
+
+    try:
+        manifest = json.loads(
+            _read(container.get_object(_manifest_name(revision))).decode(
+                "utf8",
+            )
+        )
+    except ObjectDoesNotExistError:
+        # Revisions stored before we started using blobs only have a tarball
+        obj = container.get_object(
+            "files/{revision}.tar.xz".format(revision=revision),
+        )
+        with tarfile.open(fileobj=io.BytesIO(_read(obj)), mode="r") as tb:
+            for member in tb:
+                if not member.isfile():
+                    continue
+
+                if _wanted(directory, member.name, filenames):
+                    _write(
+                        directory,
+                        member.name,
+                        tb.extractfile(member).read(),
+                    )
+
+        return
+
+    # Manifests written before codecs were configurable are a bare mapping
+    # of file names to xz compressed blobs.
+    if "codec" not in manifest:
+        manifest = {"codec": "xz", "files": manifest}
+
+    codec = compression.get_codec(manifest["codec"])
+
+    # Rebuild the source tree out of the blobs the manifest points at
+    with _pool(config) as pool:
+        futures = [
+            pool.submit(
+                _fetch_blob, config, codec, directory, filename, digest,
+            )
+            for filename, digest in manifest["files"].items()
+            if _wanted(directory, filename, filenames)
+        ]
+
+        # Raise any errors that happened while downloading
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
@@ -0,0 +1,97 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import tempfile
+import threading
+
+from libcloud.common.openstack_identity import OpenStackAuthenticationCache
+from libcloud.storage.base import Container
+from libcloud.storage.types import Provider
+from libcloud.storage.providers import get_driver
+
+
+class _AuthCache(OpenStackAuthenticationCache):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contexts = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._contexts.get(key)
+
+    def put(self, key, context):
+        with self._lock:
+            self._contexts[key] = context
+
+    def clear(self, key):
+        with self._lock:
+            self._contexts.pop(key, None)
+
+
+# Every driver in this process shares one auth token and service catalog
+_auth_cache = _AuthCache()
+
+# The underlying connections aren't safe to share between threads, so each
+# thread lazily creates and then holds onto its own driver.
+_local = threading.local()
+
+
+def get_container(config):
+    key = (
+        config["RACKSPACE_USER"],
+        config["RACKSPACE_APIKEY"],
+        config["RACKSPACE_REGION"],
+        config["BUCKET"],
+    )
+
+    containers = getattr(_local, "containers", None)
+    if containers is None:
+        containers = _local.containers = {}
+
+    container = containers.get(key)
+    if container is None:
+        container = containers[key] = Container(
+            config["BUCKET"],
+            None,
+            get_driver(Provider.CLOUDFILES)(
+                config["RACKSPACE_USER"],
+                config["RACKSPACE_APIKEY"],
+                region=config["RACKSPACE_REGION"],
+                ex_auth_cache=_auth_cache,
+            ),
+        )
+
+    return container
+
+
+def upload_file(container, fileobj, name, extra=None):
+    # libcloud only hashes an upload after it has been sent, by rewinding and
+    # reading it again, so it has to be given something it can rewind. A
+    # generator would have been used up, and hash as if it were empty.
+    fileobj.seek(0)
+    return container.upload_object_via_stream(fileobj, name, extra=extra)
+
+
+def upload_bytes(container, data, name, extra=None):
+    return upload_file(container, io.BytesIO(data), name, extra=extra)
+
+
+def upload_chunks(container, iterable, name, extra=None):
+    # Spool to disk rather than memory, so large uploads stay out of memory
+    with tempfile.TemporaryFile() as fp:
+        for chunk in iterable:
+            fp.write(chunk)
+
+        return upload_file(container, fp, name, extra=extra)
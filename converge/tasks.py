@@ -11,88 +11,587 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import io
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
 import json
-import lzma
+import logging
+import mimetypes
 import os.path
-import tarfile
+import shutil
 import tempfile
+import threading
+import time
 
-from coverage import CoverageData, coverage
-from libcloud.storage.base import Container
-from libcloud.storage.types import Provider
-from libcloud.storage.providers import get_driver
+from coverage import coverage
+from coverage.html import HtmlStatus
+from coverage.results import Numbers
+from coverage.version import __version__ as coverage_version
+from libcloud.storage.types import ObjectDoesNotExistError
 
-from converge.utils import make_real_path
+from converge import compression
+from converge import sources
+from converge.cache import TreeCache
+from converge.merge import CoverageAccumulator
+from converge.storage import get_container, upload_bytes
+from converge.utils import file_chunks
 
 
-def process_revision(config, revision):
-    storage = get_driver(Provider.CLOUDFILES)(
-        config["RACKSPACE_USER"],
-        config["RACKSPACE_APIKEY"],
-        region=config["RACKSPACE_REGION"],
+logger = logging.getLogger(__name__)
+
+
+# Where coverage keeps the fingerprints it uses to skip unchanged pages
+RENDER_STATUS = "status.dat"
+
+
+_source_cache = None
+_source_cache_lock = threading.Lock()
+
+
+def _get_source_cache(config):
+    global _source_cache
+
+    # Source trees are only kept between jobs if we've been given somewhere
+    # to put them, which can be a tmpfs to keep them in memory.
+    if not config.get("SOURCE_CACHE_DIR"):
+        return
+
+    with _source_cache_lock:
+        if _source_cache is None:
+            _source_cache = TreeCache(
+                config["SOURCE_CACHE_DIR"],
+                int(config.get("SOURCE_CACHE_SIZE", 512 * 1024 * 1024)),
+            )
+
+        return _source_cache
+
+
+@contextlib.contextmanager
+def _source_tree(config, revision):
+    cache = _get_source_cache(config)
+
+    if cache is None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield tmpdir
+    else:
+        with cache.tree(revision) as tmpdir:
+            yield tmpdir
+
+
+def rendered_builds(config, revision):
+    container = get_container(config)
+
+    # Get the builds that went into the last report we rendered
+    try:
+        obj = container.get_object(
+            "renders/{revision}.json".format(revision=revision),
+        )
+    except ObjectDoesNotExistError:
+        return {}
+
+    return json.loads(b"".join(obj.as_stream()).decode("utf8"))["builds"]
+
+
+def _merge_data(config, obj, accumulator):
+    # Each thread has to use its own driver to download with
+    driver = get_container(config).driver
+    codec = compression.from_name(obj.name)
+
+    data = b"".join(driver.download_object_as_stream(obj))
+
+    # A build we can't make sense of shouldn't stop the rest of the revision
+    # from being rendered, so leave it out of the report.
+    try:
+        datum = json.loads(codec.decompress(data).decode("utf8"))
+
+        # Fold this build into the merged data and let go of it straight away
+        accumulator.add(datum["data"])
+    except compression.DECOMPRESSION_ERRORS + (
+            AttributeError, LookupError, TypeError, ValueError):
+        logger.exception("Skipping unreadable build data %s", obj.name)
+
+
+def _load_checkpoint(container, codec, revision, builds):
+    accumulator = CoverageAccumulator()
+
+    try:
+        obj = container.get_object(
+            "checkpoints/{revision}{ext}".format(
+                revision=revision,
+                ext=codec.extension,
+            ),
+        )
+    except ObjectDoesNotExistError:
+        return accumulator, {}
+
+    checkpoint = json.loads(
+        codec.decompress(b"".join(obj.as_stream())).decode("utf8"),
     )
 
-    # Get our data files
-    data = []
-    for obj in storage.iterate_container_objects(
-            Container(config["BUCKET"], None, storage),
-            ex_prefix="data/{}".format(revision)):
-        obj_data = b""
-        for chunk in obj.as_stream():
-            obj_data += chunk
-        data.append(json.loads(lzma.decompress(obj_data).decode("utf8")))
-
-    # Get our source files
-    obj = storage.get_object(
-        config["BUCKET"],
-        "files/{revision}.tar.xz".format(revision=revision),
+    # We can only add builds to a checkpoint, so if any build in it has been
+    # replaced or removed since then we have to start over.
+    if any(builds.get(b) != h for b, h in checkpoint["builds"].items()):
+        return accumulator, {}
+
+    accumulator.add(checkpoint["data"])
+
+    return accumulator, checkpoint["builds"]
+
+
+def _save_checkpoint(container, codec, revision, builds, accumulator):
+    upload_bytes(
+        container,
+        codec.compress(
+            json.dumps({
+                "builds": builds,
+                "data": accumulator.dump(),
+            }).encode("utf8"),
+        ),
+        "checkpoints/{revision}{ext}".format(
+            revision=revision,
+            ext=codec.extension,
+        ),
     )
-    tarball = b""
-    for chunk in obj.as_stream():
-        tarball += chunk
-
-    # Write out our source files into a temporary location
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # Extract the tarball to our temporary directory
-        with tarfile.open(fileobj=io.BytesIO(tarball), mode="r") as tb:
-            tb.extractall(tmpdir)
-
-        cdata = CoverageData()
-
-        for datum in data:
-            cdata.add_line_data({
-                make_real_path(tmpdir, k): dict.fromkeys(v)
-                for k, v in datum["data"].get("lines", {}).items()
-            })
-            cdata.add_arc_data({
-                make_real_path(tmpdir, k): dict.fromkeys(map(tuple, v))
-                for k, v in datum["data"].get("arcs", {}).items()
+
+
+@contextlib.contextmanager
+def _render_directory(config, revision):
+    # coverage only trusts the fingerprints of a previous render if it was
+    # written to the same directory, so always render a revision to the same
+    # place and make sure only one job at a time is using it.
+    htmldir = os.path.join(
+        config.get("RENDER_DIR", tempfile.gettempdir()),
+        "converge-html",
+        revision,
+    )
+    os.makedirs(os.path.dirname(htmldir), exist_ok=True)
+
+    with open(htmldir + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            shutil.rmtree(htmldir, ignore_errors=True)
+            os.makedirs(htmldir)
+
+            yield htmldir
+        finally:
+            shutil.rmtree(htmldir, ignore_errors=True)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _render_status_name(revision):
+    return "renders/{revision}.status.json".format(revision=revision)
+
+
+def _fetch_render_status(container, revision, htmldir):
+    # Coverage keeps its fingerprints as a pickle, which we must never load
+    # from the bucket as anyone who could write to it could then run code on
+    # our workers. Instead we keep them as JSON and write the pickle ourselves.
+    try:
+        obj = container.get_object(_render_status_name(revision))
+    except ObjectDoesNotExistError:
+        return
+
+    try:
+        saved = json.loads(b"".join(obj.as_stream()).decode("utf8"))
+
+        # Another version of coverage may lay its report out differently
+        if saved["version"] != coverage_version:
+            return
+
+        status = HtmlStatus()
+        status.set_settings_hash(bytes.fromhex(saved["settings"]))
+        for fname, info in saved["files"].items():
+            status.set_file_hash(fname, bytes.fromhex(info["hash"]))
+            status.set_index_info(fname, {
+                "html_filename": str(info["index"]["html_filename"]),
+                "name": str(info["index"]["name"]),
+                "nums": Numbers(**{
+                    k: int(v) for k, v in info["index"]["nums"].items()
+                }),
             })
+    except (ValueError, KeyError, TypeError, AttributeError):
+        # We'll just have to render every page again
+        logger.warning("Ignoring unreadable render status for %s", revision)
+        return
+
+    status.write(htmldir)
+
+
+def _save_render_status(container, revision, htmldir):
+    # This is the status.dat that coverage just wrote for us, so it's safe to
+    # load it.
+    status = HtmlStatus()
+    status.read(htmldir)
+
+    files = {}
+    for fname, info in status.files.items():
+        # Pages that didn't render have nothing we could reuse next time
+        if "hash" not in info or "index" not in info:
+            continue
+
+        files[fname] = {
+            "hash": info["hash"].hex(),
+            "index": {
+                "html_filename": info["index"]["html_filename"],
+                "name": info["index"]["name"],
+                "nums": vars(info["index"]["nums"]),
+            },
+        }
+
+    upload_bytes(
+        container,
+        json.dumps(
+            {
+                "version": coverage_version,
+                "settings": status.settings_hash().hex(),
+                "files": files,
+            },
+            sort_keys=True,
+        ).encode("utf8"),
+        _render_status_name(revision),
+        extra={"content_type": "application/json"},
+    )
+
+
+class UploadError(Exception):
+
+    def __init__(self, failures):
+        super().__init__(
+            "Failed to upload: {}".format(", ".join(sorted(failures))),
+        )
+        self.failures = failures
+
+
+def _file_hash(path):
+    digest = hashlib.md5()
+    with open(path, "rb") as fp:
+        for chunk in file_chunks(fp):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _upload_file(config, path, name, retries):
+    # Each thread uploads using its own connection
+    container = get_container(config)
 
-        current_directory = os.path.abspath(".")
+    for attempt in range(retries + 1):
         try:
-            os.chdir(tmpdir)
+            container.upload_object(path, name)
+        except Exception:
+            if attempt >= retries:
+                raise
 
-            cov = coverage()
-            cov.data = cdata
+            logger.warning("Retrying upload of %s", name, exc_info=True)
+            time.sleep(2 ** attempt)
+        else:
+            return os.path.getsize(path)
+
+
+def _upload_report(config, container, revision, htmldir):
+    prefix = "html/{}/".format(revision)
+
+    # Find out what we already have stored, so that we only upload the files
+    # which have actually changed.
+    existing = {
+        obj.name: obj.hash
+        for obj in container.driver.iterate_container_objects(
+            container,
+            ex_prefix=prefix,
+        )
+    }
+
+    uploads = []
+    for dirname, dirnames, filenames in os.walk(htmldir):
+        for filename in filenames:
+            path = os.path.join(dirname, filename)
+            relpath = os.path.relpath(path, htmldir)
+            name = prefix + relpath
+
+            if relpath == RENDER_STATUS:
+                continue
+
+            if existing.get(name) == _file_hash(path):
+                continue
+
+            uploads.append((path, name))
+
+    started = time.monotonic()
+    uploaded, failures = 0, {}
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(config.get("UPLOAD_CONCURRENCY", 8))) as pool:
+        futures = {
+            pool.submit(
+                _upload_file,
+                config,
+                path,
+                name,
+                int(config.get("UPLOAD_RETRIES", 3)),
+            ): name
+            for path, name in uploads
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                uploaded += future.result()
+            except Exception as exc:
+                logger.error(
+                    "Failed to upload %s", futures[future], exc_info=True,
+                )
+                failures[futures[future]] = exc
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        "Uploaded %d of %d files (%d bytes) for %s in %.2fs (%.1f KiB/s)",
+        len(uploads) - len(failures),
+        len(uploads),
+        uploaded,
+        revision,
+        elapsed,
+        uploaded / 1024 / elapsed if elapsed else 0,
+    )
+
+    if failures:
+        raise UploadError(failures)
+
+
+def _pack_report(htmldir, fp):
+    # Concatenate every file in the report into fp, returning an index of
+    # where each one ended up.
+    files = {}
+    digest = hashlib.md5()
+    for dirname, dirnames, filenames in os.walk(htmldir):
+        for filename in sorted(filenames):
+            path = os.path.join(dirname, filename)
+            relpath = os.path.relpath(path, htmldir)
+
+            if relpath == RENDER_STATUS:
+                continue
+
+            content_type, _ = mimetypes.guess_type(filename)
+            offset = fp.tell()
+            file_digest = hashlib.md5()
+            with open(path, "rb") as page:
+                for chunk in file_chunks(page):
+                    fp.write(chunk)
+                    digest.update(chunk)
+                    file_digest.update(chunk)
+
+            files[relpath] = {
+                "offset": offset,
+                "length": fp.tell() - offset,
+                "content_type": content_type or "application/octet-stream",
+                "hash": file_digest.hexdigest(),
+            }
+
+    return digest.hexdigest(), files
+
+
+def _upload_pack(config, container, revision, htmldir):
+    prefix = "reports/{}/".format(revision)
+
+    with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(htmldir), suffix=".pack") as fp:
+        digest, files = _pack_report(htmldir, fp)
+        fp.flush()
+
+        # Every pack gets its own name, so anyone still holding the previous
+        # index never reads from a pack it doesn't describe.
+        name = "{prefix}{digest}.pack".format(prefix=prefix, digest=digest)
+        size = _upload_file(
+            config,
+            fp.name,
+            name,
+            int(config.get("UPLOAD_RETRIES", 3)),
+        )
+
+    logger.info(
+        "Uploaded a pack of %d files (%d bytes) for %s",
+        len(files),
+        size,
+        revision,
+    )
+
+    # The index goes last, so that if it exists the pack it points to does
+    # too.
+    upload_bytes(
+        container,
+        json.dumps(
+            {"pack": name, "files": files},
+            sort_keys=True,
+        ).encode("utf8"),
+        "reports/{revision}.json".format(revision=revision),
+    )
+
+    # Clean up any packs that nothing points to anymore
+    for obj in container.driver.iterate_container_objects(
+            container, ex_prefix=prefix):
+        if obj.name != name:
+            container.delete_object(obj)
+
+
+def _line_ranges(statements, lines):
+    # Collapse lines into [start, end] ranges, a range only ends when we hit
+    # a statement that isn't in lines, so blank lines and comments don't
+    # break it up.
+    ranges = []
+    start = end = None
+    for number in sorted(statements):
+        if number in lines:
+            if start is None:
+                start = number
+            end = number
+        elif start is not None:
+            ranges.append([start, end])
+            start = None
+
+    if start is not None:
+        ranges.append([start, end])
+
+    return ranges
+
+
+def _numbers(numbers):
+    return {
+        "statements": numbers.n_statements,
+        "missing": numbers.n_missing,
+        "excluded": numbers.n_excluded,
+        "branches": numbers.n_branches,
+        "partial_branches": numbers.n_partial_branches,
+        "missing_branches": numbers.n_missing_branches,
+        "percent_covered": numbers.pc_covered,
+    }
+
+
+def _summarize(cov, revision, builds):
+    total = Numbers()
+    files = {}
+    for filename in sorted(cov.data.measured_files()):
+        analysis = cov._analyze(filename)
+        total += analysis.numbers
+
+        summary = _numbers(analysis.numbers)
+        summary["missing_lines"] = _line_ranges(
+            analysis.statements,
+            analysis.missing,
+        )
+        files[cov.file_locator.relative_filename(filename)] = summary
+
+    return {
+        "revision": revision,
+        "builds": builds,
+        "totals": _numbers(total),
+        "files": files,
+    }
+
+
+def process_revision(config, revision):
+    container = get_container(config)
+    codec = compression.from_config(config)
+
+    # Find our data files, and keep track of which builds (and which version
+    # of each build) this report is made up of.
+    prefix = "data/{}/".format(revision)
+    objs = {}
+    for obj in container.driver.iterate_container_objects(
+            container, ex_prefix=prefix):
+        build = compression.strip_extension(obj.name[len(prefix):])
+
+        # A build re-uploaded after the codec changed can briefly be stored
+        # with both, in which case the newest upload is the one we want.
+        current = objs.get(build)
+        modified = obj.extra["last_modified"]
+        if current is None or modified > current.extra["last_modified"]:
+            objs[build] = obj
+    builds = {build: obj.hash for build, obj in objs.items()}
+
+    # Start from everything we've already merged for this revision
+    accumulator, merged = _load_checkpoint(container, codec, revision, builds)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=int(config.get("FETCH_CONCURRENCY", 8))) as pool:
+        # Download, decode and merge any new data files in parallel
+        futures = [
+            pool.submit(_merge_data, config, obj, accumulator)
+            for build, obj in objs.items()
+            if build not in merged
+        ]
+
+        # Raise any errors that happened while merging
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    # Save what we've merged so the next run only has to add new builds
+    if futures:
+        _save_checkpoint(container, codec, revision, builds, accumulator)
+
+    with _source_tree(config, revision) as tmpdir:
+        # Write out just the source files that we have coverage data for (and
+        # the project's .coveragerc), anything already there from an earlier
+        # job is reused.
+        sources.materialize(
+            config,
+            revision,
+            tmpdir,
+            filenames=accumulator.paths(),
+        )
+
+        cdata = accumulator.coverage_data(tmpdir)
+
+        # Don't let anything about our working directory leak into the report,
+        # the file names in it are relative to our source files instead. The
+        # project's own settings still apply though.
+        rcfile = os.path.join(tmpdir, ".coveragerc")
+        cov = coverage(
+            config_file=rcfile if os.path.exists(rcfile) else False,
+        )
+        cov.file_locator.relative_dir = os.path.normcase(
+            os.path.join(os.path.realpath(tmpdir), ""),
+        )
+        cov.data = cdata
+
+        with _render_directory(config, revision) as htmldir:
+            if config.get("REPORT_FORMAT", "files") == "packed":
+                # A pack is always written out in full, so every page
+                # needs to be rendered.
+                cov.html_report(directory=htmldir)
+
+                # Upload the HTML report as a single pack and an index
+                _upload_pack(config, container, revision, htmldir)
+            else:
+                # Start from the fingerprints of our last render, coverage
+                # will then only write out the pages that have changed.
+                _fetch_render_status(container, revision, htmldir)
 
-            with tempfile.TemporaryDirectory() as htmldir:
                 # Generate a HTML report for our data
                 cov.html_report(directory=htmldir)
 
-                # Upload the HTML report
-                for dirname, dirnames, filenames in os.walk(htmldir):
-                    for filename in filenames:
-                        path = os.path.relpath(
-                            os.path.join(dirname, filename),
-                            htmldir,
-                        )
-
-                        storage.upload_object(
-                            os.path.join(htmldir, path),
-                            Container(config["BUCKET"], None, storage),
-                            os.path.join("html", revision, path),
-                        )
-        finally:
-            os.chdir(current_directory)
+                # Upload the HTML report, which only contains the pages
+                # that were regenerated along with the index.
+                _upload_report(config, container, revision, htmldir)
+
+                # Save our fingerprints now that the report they describe
+                # is in place.
+                _save_render_status(container, revision, htmldir)
+
+        # Save a summary of the report for anything that just wants numbers
+        upload_bytes(
+            container,
+            json.dumps(
+                _summarize(cov, revision, builds),
+                sort_keys=True,
+            ).encode("utf8"),
+            "summaries/{revision}.json".format(revision=revision),
+            extra={"content_type": "application/json"},
+        )
+
+    # Record what went into this report so that any queued events for data
+    # we've already rendered can be skipped.
+    upload_bytes(
+        container,
+        json.dumps({"builds": builds}).encode("utf8"),
+        "renders/{revision}.json".format(revision=revision),
+    )
+
+    return builds
@@ -12,12 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os.path
-import itertools
 
 
-def chunks(iterable, n):
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args, fillvalue=None)
+# The default size of the chunks we stream uploads in
+CHUNK_SIZE = 64 * 1024
+
+
+def file_chunks(fp, size=CHUNK_SIZE):
+    while True:
+        chunk = fp.read(size)
+        if not chunk:
+            break
+        yield chunk
 
 
 def make_real_path(base, path):
@@ -11,21 +11,36 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
+import concurrent.futures
 import datetime
 import io
 import json
-import lzma
 import os
 import tarfile
+import threading
+import time
+import uuid
 
-from flask import Flask, abort, request
+from flask import Flask, Response, abort, request
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import BadRequest
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import (
+    is_resource_modified, parse_date, quote_etag, remove_entity_headers,
+    unquote_etag,
+)
+from werkzeug.wsgi import wrap_file
 
-from libcloud.storage.base import Container
-from libcloud.storage.types import Provider, ObjectDoesNotExistError
-from libcloud.storage.providers import get_driver
+from libcloud.storage.base import Object
+from libcloud.storage.types import ObjectDoesNotExistError
 
+from converge import compression
 from converge import marconi as queue
-from converge.utils import chunks
+from converge import sources
+from converge.cache import DiskCache
+from converge.storage import get_container, upload_chunks
+from converge.utils import file_chunks
 
 
 app = Flask("converge")
@@ -38,128 +53,607 @@ app.config.update({
 })
 
 
-@app.route("/<revision_id>/", methods=["HEAD", "GET"])
-@app.route("/<revision_id>/<path:path>", methods=["HEAD", "GET"])
-def html(revision_id, path="index.html"):
-    container = Container(
-        app.config["BUCKET"],
-        None,
-        get_driver(Provider.CLOUDFILES)(
-            app.config["RACKSPACE_USER"],
-            app.config["RACKSPACE_APIKEY"],
-            region=app.config["RACKSPACE_REGION"],
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _get_cache():
+    global _cache
+
+    # Rendered reports are only cached locally if we've been given somewhere
+    # to put them.
+    if not app.config.get("CACHE_DIR"):
+        return
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = DiskCache(
+                app.config["CACHE_DIR"],
+                int(app.config.get("CACHE_SIZE", 512 * 1024 * 1024)),
+            )
+
+        return _cache
+
+
+# revision -> (expires, index) for the packed reports we've looked up,
+# ordered from least to most recently used
+_indexes = collections.OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _get_index(container, revision, refresh=False):
+    now = time.monotonic()
+
+    with _indexes_lock:
+        entry = _indexes.get(revision)
+        if entry is not None and not refresh and entry[0] > now:
+            _indexes.move_to_end(revision)
+            return entry[1]
+
+    # We remember revisions that don't have a pack too, so that reports
+    # which were uploaded as files don't pay for a lookup on every request.
+    try:
+        obj = container.get_object(
+            "reports/{revision}.json".format(revision=revision),
+        )
+    except ObjectDoesNotExistError:
+        index = None
+    else:
+        index = json.loads(b"".join(obj.as_stream()).decode("utf8"))
+
+    with _indexes_lock:
+        _indexes[revision] = (
+            now + float(app.config.get("INDEX_TTL", 60)),
+            index,
+        )
+        _indexes.move_to_end(revision)
+
+        while len(_indexes) > int(app.config.get("INDEX_CACHE_SIZE", 128)):
+            _indexes.popitem(last=False)
+
+    return index
+
+
+def _cache_headers(etag):
+    # Everything we serve is replaced whenever a revision is rendered again,
+    # so clients should only hold onto it for a short while before
+    # revalidating it using the hash.
+    return {
+        "ETag": quote_etag(etag),
+        "Cache-Control": "public, max-age={}".format(
+            app.config.get("CACHE_MAX_AGE", 60),
         ),
+    }
+
+
+def _object_headers(obj):
+    headers = {k.replace("_", "-"): v for k, v in obj.extra.items()}
+    headers["Content-Length"] = str(obj.size)
+    headers.update(_cache_headers(obj.hash))
+
+    return headers
+
+
+def _packed_headers(entry):
+    headers = {
+        "Content-Type": entry["content_type"],
+        "Content-Length": str(entry["length"]),
+    }
+    headers.update(_cache_headers(entry["hash"]))
+
+    return headers
+
+
+def _is_modified(headers):
+    etag = headers.get("ETag")
+    last_modified = headers.get("last-modified")
+
+    return is_resource_modified(
+        request.environ,
+        etag=unquote_etag(etag)[0] if etag else None,
+        last_modified=parse_date(last_modified) if last_modified else None,
     )
 
-    # See if the requested file exists
+
+def _not_modified(headers):
+    headers = Headers(headers)
+    remove_entity_headers(headers)
+
+    return Response(status=304, headers=headers)
+
+
+def _send(headers, stream, key):
+    # If the client already has this file, there's no reason to send it again
+    if not _is_modified(headers):
+        return _not_modified(headers)
+
+    # We already know everything a HEAD request needs, so there's no reason
+    # to download the file itself.
+    if request.method == "HEAD":
+        return Response(headers=headers)
+
+    cache = _get_cache()
+
+    # Serve the file from our local cache if we can
+    if cache is not None:
+        def fetch(fp):
+            for chunk in stream():
+                fp.write(chunk)
+            return headers
+
+        fp, headers = cache.get(key, fetch)
+
+        return Response(
+            wrap_file(request.environ, fp),
+            headers=headers,
+            direct_passthrough=True,
+        )
+
+    # Stream the requested file to the client as we receive it
+    return Response(stream(), headers=headers)
+
+
+def _packed(container, index, path):
+    entry = index["files"].get(path)
+    if entry is None:
+        abort(404)
+
+    # We know where the pack is from the index, so we can skip asking Cloud
+    # Files about it and go straight to fetching the part we want.
+    pack = Object(
+        index["pack"], None, None, {}, {}, container, container.driver,
+    )
+
+    def stream():
+        # A range can't be empty, and there's nothing to fetch anyway
+        if not entry["length"]:
+            return iter([b""])
+
+        return container.driver.download_object_range_as_stream(
+            pack,
+            entry["offset"],
+            entry["offset"] + entry["length"],
+        )
+
+    return _send(
+        _packed_headers(entry),
+        stream,
+        "{}/{}".format(index["pack"], path),
+    )
+
+
+@app.route("/<revision_id>/summary.json", methods=["HEAD", "GET"])
+def summary(revision_id):
+    container = get_container(app.config)
+
     try:
         obj = container.get_object(
-            "html/{revision}/{path}".format(revision=revision_id, path=path)
+            "summaries/{revision}.json".format(revision=revision_id),
         )
     except ObjectDoesNotExistError:
         abort(404)
 
-    # Get the requested file
-    data = b""
-    for chunk in obj.as_stream():
-        data += chunk
+    return _send(
+        _object_headers(obj),
+        obj.as_stream,
+        "{name}@{hash}".format(name=obj.name, hash=obj.hash),
+    )
+
+
+@app.route("/<revision_id>/", methods=["HEAD", "GET"])
+@app.route("/<revision_id>/<path:path>", methods=["HEAD", "GET"])
+def html(revision_id, path="index.html"):
+    container = get_container(app.config)
+
+    # Reports can be stored as a single pack, in which case we serve pages
+    # out of it with ranged requests.
+    if app.config.get("REPORT_FORMAT", "files") == "packed":
+        for refresh in [False, True]:
+            index = _get_index(container, revision_id, refresh=refresh)
+            if index is None:
+                break
+
+            try:
+                return _packed(container, index, path)
+            except ObjectDoesNotExistError:
+                # The report has been rendered again since we fetched our
+                # index and the pack it pointed to is gone, so try again with
+                # the current one.
+                continue
+        else:
+            abort(404)
+
+    name = "html/{revision}/{path}".format(revision=revision_id, path=path)
+
+    # Pages are replaced every time the revision is rendered again, so ask
+    # Cloud Files what the current version is. Our local cache is keyed on
+    # the hash as well as the name, so we never serve an old version of it.
+    try:
+        obj = container.get_object(name)
+    except ObjectDoesNotExistError:
+        abort(404)
+
+    return _send(
+        _object_headers(obj),
+        obj.as_stream,
+        "{name}@{hash}".format(name=obj.name, hash=obj.hash),
+    )
 
-    return data, 200, {k.replace("_", "-"): v for k, v in obj.extra.items()}
 
+def _coverage_document(meta, coverage_data, address, timestamp):
+    # Write out the envelope around the coverage data ourselves so that the
+    # data itself can be passed straight through without being parsed.
+    envelope = json.dumps({
+        "timestamp": timestamp,
+        "address": address,
+        "meta": meta,
+    })
+    yield envelope[:-1].encode("utf8") + b', "data": '
+    yield from coverage_data
+    yield b"}"
 
-@app.route("/revision/<revision_id>/<build_id>/", methods=["PUT"])
-def build(revision_id, build_id):
-    # Check our authentication
+
+def _json_source_files(source_files):
+    for filename, file_data in source_files.items():
+        # Encode our file_data using utf8 so we can store it
+        file_data = file_data.encode("utf8")
+
+        yield filename, len(file_data), io.BytesIO(file_data)
+
+
+def _tar_source_files(fileobj):
+    # Read the uploaded archive as a stream, it can use any compression that
+    # tarfile understands.
+    with tarfile.open(fileobj=fileobj, mode="r|*") as tarball:
+        for member in tarball:
+            if member.isfile():
+                yield member.name, member.size, tarball.extractfile(member)
+
+
+def _check_auth():
     if not request.headers.get("X-Auth-Token") == app.config["AUTH_TOKEN"]:
         abort(403)
 
-    container = Container(
-        app.config["BUCKET"],
-        None,
-        get_driver(Provider.CLOUDFILES)(
-            app.config["RACKSPACE_USER"],
-            app.config["RACKSPACE_APIKEY"],
-            region=app.config["RACKSPACE_REGION"],
-        ),
+
+def _json_response(data, status=200):
+    return json.dumps(data), status, {"Content-Type": "application/json"}
+
+
+def _multipart_upload(form, files):
+    # Multipart uploads are spooled to disk as they're parsed, so we can
+    # stream them back out without ever holding them in memory.
+    meta = {"pr": form.get("pr"), "branch": form.get("branch")}
+    coverage_data = file_chunks(files["coverage_data"].stream)
+    source_files = (
+        _tar_source_files(files["source_files"].stream)
+        if "source_files" in files else []
     )
+    try:
+        source_manifest = json.loads(form.get("source_manifest", "{}"))
+    except ValueError:
+        abort(400)
+    sent_sources = bool("source_files" in files or source_manifest)
+
+    return meta, coverage_data, source_files, source_manifest, sent_sources
+
+
+def _json_upload(payload):
+    meta = {"pr": payload.get("pr"), "branch": payload.get("branch")}
+    coverage_data = [json.dumps(payload["coverage_data"]).encode("utf8")]
+    source_files = _json_source_files(payload.get("source_files", {}))
+    source_manifest = payload.get("source_manifest", {})
+    sent_sources = bool("source_files" in payload or source_manifest)
 
-    # Store the coverage data
-    container.upload_object_via_stream(
-        (
-            bytes([c for c in chunk if c is not None])
-            for chunk in chunks(
-                lzma.compress(
-                    json.dumps({
-                        "timestamp": datetime.datetime.utcnow().isoformat(),
-                        "address": request.remote_addr,
-                        "data": request.get_json()["coverage_data"],
-                        "meta": {
-                            "pr": request.get_json().get("pr"),
-                            "branch": request.get_json().get("branch"),
-                        }
-                    }).encode("utf"),
-                ),
-                2048,
+    return meta, coverage_data, source_files, source_manifest, sent_sources
+
+
+def _is_build(name, build_id):
+    try:
+        return compression.strip_extension(name).endswith("/" + build_id)
+    except ValueError:
+        return False
+
+
+def _ingest(revision_id, build_id, address, timestamp, upload):
+    meta, coverage_data, source_files, source_manifest, sent_sources = upload
+
+    container = get_container(app.config)
+    codec = compression.from_config(app.config)
+
+    # Builds only need to send sources if we don't have them already, check
+    # that before we store anything.
+    sources_stored = sources.has_sources(container, revision_id)
+    if not sources_stored and not sent_sources:
+        return {"success": False, "sources_stored": False}, 400
+
+    # Store the sources first, so that a build with bad sources is turned
+    # away before any of it has been stored.
+    if not sources_stored:
+        try:
+            sources.store_sources(
+                app.config,
+                codec,
+                revision_id,
+                source_files,
+                manifest=source_manifest,
             )
+        except sources.MissingSourcesError as exc:
+            return {"success": False, "missing": exc.missing}, 400
+        except (ValueError, tarfile.TarError):
+            return {"success": False}, 400
+
+    # Store the coverage data, compressing it as it's uploaded
+    obj = upload_chunks(
+        container,
+        codec.compress_chunks(
+            _coverage_document(meta, coverage_data, address, timestamp),
         ),
-        "data/{revision}/{build}.xz".format(
+        "data/{revision}/{build}{ext}".format(
             revision=revision_id,
             build=build_id,
+            ext=codec.extension,
         ),
     )
 
-    try:
-        container.get_object(
-            "files/{revision}.tar.xz".format(revision=revision_id)
-        )
-    except ObjectDoesNotExistError:
-        # Generate a tarball of the source files
-        tarxz = io.BytesIO()
-        with tarfile.open(
-                "{}.tar.xz".format(revision_id),
-                "w:xz",
-                fileobj=tarxz) as tarball:
-            for filename, file_data in (
-                    request.get_json()["source_files"].items()):
-                # Encode our file_data using utf8 so we can store it
-                file_data = file_data.encode("utf8")
-
-                # Add the file to the tarball
-                info = tarfile.TarInfo(name=filename)
-                info.size = len(file_data)
-                tarball.addfile(tarinfo=info, fileobj=io.BytesIO(file_data))
-
-        # Store the files tarball
-        container.upload_object_via_stream(
-            (
-                bytes([c for c in chunk if c is not None])
-                for chunk in chunks(tarxz.getvalue(), 2048)
-            ),
-            "files/{revision}.tar.xz".format(revision=revision_id),
-        )
+    # If this build was uploaded before with a different codec, get rid of
+    # that copy so it can't be mistaken for this one.
+    for other in container.driver.iterate_container_objects(
+            container,
+            ex_prefix="data/{revision}/{build}.".format(
+                revision=revision_id,
+                build=build_id,
+            )):
+        if other.name != obj.name and _is_build(other.name, build_id):
+            container.delete_object(other)
 
     try:
         queue.push(
             app.config["RACKSPACE_USER"],
             app.config["RACKSPACE_APIKEY"],
             app.config["QUEUE"],
-            {"event": "revision.process", "revision": revision_id},
+            {
+                "event": "revision.process",
+                "revision": revision_id,
+                "build": build_id,
+                "hash": obj.hash,
+            },
             region=app.config["RACKSPACE_REGION"],
         )
     except queue.QueueException:
-        return (
-            json.dumps({"success": False}),
-            503,
-            {"Content-Type": "application/json"},
+        return {"success": False}, 503
+
+    # Return Information, including that later builds of this revision can
+    # leave out their sources.
+    return {"success": True, "sources_stored": True}, 200
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _scan_spool():
+    spool = app.config["INGEST_SPOOL"]
+    now = time.time()
+
+    for filename in sorted(os.listdir(spool)):
+        path, ext = os.path.splitext(os.path.join(spool, filename))
+
+        try:
+            if ext == ".processing":
+                # Entries are only left processing for this long if whatever
+                # was processing them died part way through, so put them
+                # back to be tried again.
+                mtime = os.stat(path + ".processing").st_mtime
+                if now - mtime > float(app.config.get("INGEST_STALE", 3600)):
+                    os.rename(path + ".processing", path + ".json")
+                    _executor.submit(_process_spooled, path)
+            elif ext == ".json":
+                with open(path + ".json", "r", encoding="utf8") as fp:
+                    info = json.load(fp)
+
+                if info.get("retry_at", 0) <= now:
+                    _executor.submit(_process_spooled, path)
+        except (OSError, ValueError):
+            # Something else got to this entry first
+            continue
+
+
+def _watch_spool():
+    # Keep picking up anything that was spooled but never processed, either
+    # because we were restarted or because it failed and is due a retry.
+    while True:
+        try:
+            _scan_spool()
+        except Exception:
+            app.logger.exception("Could not scan the ingest spool")
+
+        time.sleep(float(app.config.get("INGEST_RESCAN", 30)))
+
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            os.makedirs(app.config["INGEST_SPOOL"], exist_ok=True)
+
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=int(app.config.get("INGEST_WORKERS", 2)),
+            )
+
+            threading.Thread(target=_watch_spool, daemon=True).start()
+
+        return _executor
+
+
+@app.before_request
+def _start_ingest():
+    # Start processing the spool as soon as we're serving requests, rather
+    # than waiting for the next build to be spooled.
+    if app.config.get("INGEST_SPOOL") and _executor is None:
+        _get_executor()
+
+
+def _spool(revision_id, build_id):
+    os.makedirs(app.config["INGEST_SPOOL"], exist_ok=True)
+    path = os.path.join(app.config["INGEST_SPOOL"], uuid.uuid4().hex)
+
+    # Write the raw body out to disk as fast as we can, all of the actual
+    # work happens later on a background thread.
+    with open(path + ".body", "wb") as fp:
+        for chunk in file_chunks(request.stream):
+            fp.write(chunk)
+
+    # The metadata goes last, as its presence means the spool entry is
+    # complete and ready to be processed.
+    with open(path + ".tmp", "w", encoding="utf8") as fp:
+        json.dump({
+            "revision": revision_id,
+            "build": build_id,
+            "address": request.remote_addr,
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "mimetype": request.mimetype,
+            "content_type": request.content_type,
+            "content_length": os.path.getsize(path + ".body"),
+        }, fp)
+    os.replace(path + ".tmp", path + ".json")
+
+    _get_executor().submit(_process_spooled, path)
+
+
+def _process_spooled(path):
+    # Claim the spool entry, if this fails something else already has it
+    try:
+        os.rename(path + ".json", path + ".processing")
+    except FileNotFoundError:
+        return
+
+    # Mark when we claimed it, so that we can tell if we die holding it
+    os.utime(path + ".processing")
+
+    with open(path + ".processing", "r", encoding="utf8") as fp:
+        info = json.load(fp)
+
+    try:
+        with open(path + ".body", "rb") as fp:
+            if info["mimetype"] == "multipart/form-data":
+                _, form, files = parse_form_data({
+                    "wsgi.input": fp,
+                    "REQUEST_METHOD": "PUT",
+                    "CONTENT_TYPE": info["content_type"],
+                    "CONTENT_LENGTH": str(info["content_length"]),
+                })
+                upload = _multipart_upload(form, files)
+            else:
+                upload = _json_upload(json.loads(fp.read().decode("utf8")))
+
+            data, status = _ingest(
+                info["revision"],
+                info["build"],
+                info["address"],
+                info["timestamp"],
+                upload,
+            )
+    except (ValueError, KeyError, BadRequest) as exc:
+        # The build itself is broken, so trying it again won't help
+        data, status = {"success": False, "error": repr(exc)}, 400
+    except Exception:
+        app.logger.exception(
+            "Could not ingest build %s of %s", info["build"], info["revision"],
+        )
+        status = 500
+
+    info["attempts"] = info.get("attempts", 0) + 1
+    max_attempts = int(app.config.get("INGEST_MAX_ATTEMPTS", 10))
+
+    if status >= 500 and info["attempts"] < max_attempts:
+        # Put the entry back to be retried, backing off for longer each time
+        # it fails.
+        delay = float(app.config.get("INGEST_RETRY_MIN", 10))
+        delay *= 2 ** min(info["attempts"] - 1, 16)
+        info["retry_at"] = time.time() + min(
+            delay,
+            float(app.config.get("INGEST_RETRY_MAX", 3600)),
+        )
+
+        with open(path + ".tmp", "w", encoding="utf8") as fp:
+            json.dump(info, fp)
+        os.replace(path + ".tmp", path + ".json")
+        os.unlink(path + ".processing")
+        return
+
+    if status >= 500:
+        app.logger.error(
+            "Giving up on build %s of %s after %d attempts",
+            info["build"], info["revision"], info["attempts"],
         )
+    elif status != 200:
+        app.logger.error(
+            "Rejected build %s of %s: %r",
+            info["build"], info["revision"], data,
+        )
+
+    os.unlink(path + ".body")
+    os.unlink(path + ".processing")
+
 
-    # Return Information
-    return (
-        json.dumps({"success": True}),
-        200,
-        {"Content-Type": "application/json"},
+@app.route("/sources/missing/", methods=["POST"])
+def missing_sources():
+    # Check our authentication
+    _check_auth()
+
+    # Tell the client which of the source files it has hashed we don't have
+    # yet, so it only needs to send us those.
+    try:
+        missing = sources.missing_blobs(
+            app.config,
+            compression.from_config(app.config),
+            request.get_json()["hashes"],
+        )
+    except ValueError:
+        abort(400)
+
+    return _json_response({"missing": missing})
+
+
+@app.route("/revision/<revision_id>/sources/", methods=["HEAD", "GET"])
+def revision_sources(revision_id):
+    # Check our authentication
+    _check_auth()
+
+    # If we already have the sources for this revision then builds can skip
+    # sending them altogether.
+    return _json_response({
+        "stored": sources.has_sources(get_container(app.config), revision_id),
+    })
+
+
+@app.route("/revision/<revision_id>/<build_id>/", methods=["PUT"])
+def build(revision_id, build_id):
+    # Check our authentication
+    _check_auth()
+
+    # If we have a spool, accept the build now and process it in the
+    # background.
+    if app.config.get("INGEST_SPOOL"):
+        _spool(revision_id, build_id)
+        return _json_response({"success": True}, 202)
+
+    if request.mimetype == "multipart/form-data":
+        upload = _multipart_upload(request.form, request.files)
+    else:
+        upload = _json_upload(request.get_json())
+
+    data, status = _ingest(
+        revision_id,
+        build_id,
+        request.remote_addr,
+        datetime.datetime.utcnow().isoformat(),
+        upload,
     )
 
+    return _json_response(data, status)
+
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -11,7 +11,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import argparse
+import collections
+import concurrent.futures
+import logging
 import os
+import random
 import sys
 import time
 
@@ -19,6 +24,231 @@ from converge import marconi as queue
 from converge import tasks
 
 
+logger = logging.getLogger(__name__)
+
+
+def group(claimed):
+    # Collapse all of the events for a single revision into one unit of work
+    # so that a burst of builds only renders the revision once.
+    groups = collections.OrderedDict()
+    for task in claimed:
+        if task["body"]["event"] == "revision.process":
+            groups.setdefault(task["body"]["revision"], []).append(task)
+        else:
+            raise ValueError(
+                "Unknown event '{}'".format(task["body"]["event"])
+            )
+
+    return list(groups.items())
+
+
+def process(config, revision, messages):
+    # If every build these messages were queued for has already gone into a
+    # rendered report then there is nothing left for us to do.
+    if all("build" in m["body"] for m in messages):
+        rendered = tasks.rendered_builds(config, revision)
+        if all(rendered.get(m["body"]["build"]) == m["body"]["hash"]
+               for m in messages):
+            return
+
+    tasks.process_revision(config, revision)
+
+
+class Backoff:
+
+    def __init__(self, minimum=1, maximum=30):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def delay(self):
+        # Double our ceiling for every empty poll in a row, and pick a random
+        # point below it so that idle workers drift out of lockstep. A
+        # minimum of zero would never grow, so double from a second instead.
+        step = self.minimum if self.minimum > 0 else 1
+        ceiling = min(self.maximum, step * 2 ** self.attempts)
+
+        # Once we've hit our maximum there's no reason to keep counting, and
+        # doing so would eventually overflow.
+        if ceiling < self.maximum:
+            self.attempts += 1
+
+        return random.uniform(self.minimum, max(self.minimum, ceiling))
+
+
+class Worker:
+
+    def __init__(self, config, client, concurrency=1, batch_size=10,
+                 ttl=300, backoff=None):
+        self.config = config
+        self.client = client
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.backoff = backoff if backoff is not None else Backoff()
+
+        # Rendering doesn't depend on any process wide state, so jobs can all
+        # share this process.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency,
+        )
+
+        # future -> (revision, messages) for every job that is running
+        self.jobs = {}
+
+        # revision -> messages that are claimed but not yet running, either
+        # because we're at capacity or the revision is already in flight.
+        self.pending = collections.OrderedDict()
+
+        # claim -> when we last claimed or renewed it
+        self.claims = {}
+
+    @property
+    def full(self):
+        return len(self.jobs) + len(self.pending) >= self.concurrency
+
+    def claim(self):
+        claimed = self.client.claim(
+            self.config["QUEUE"],
+            ttl=self.ttl,
+            limit=self.batch_size,
+        )
+
+        for task in claimed:
+            self.claims.setdefault(task["claim"], time.time())
+
+        for revision, messages in group(claimed):
+            self.pending.setdefault(revision, []).extend(messages)
+
+        return claimed
+
+    def start(self):
+        running = {revision for revision, _ in self.jobs.values()}
+
+        for revision in list(self.pending):
+            if len(self.jobs) >= self.concurrency:
+                break
+
+            # Never render the same revision twice at once, these messages
+            # will get picked up once the current render has finished.
+            if revision in running:
+                continue
+
+            messages = self.pending.pop(revision)
+            future = self.executor.submit(process, self.config, revision,
+                                          messages)
+            self.jobs[future] = (revision, messages)
+
+    def reap(self):
+        for future in [f for f in self.jobs if f.done()]:
+            revision, messages = self.jobs.pop(future)
+
+            # If the job failed we just stop renewing its claim, so that its
+            # messages go back to the queue to be tried again while we get on
+            # with everything else.
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Could not process %s", revision)
+                continue
+
+            # Delete the tasks now that they've been processed
+            self.client.delete_many(self.config["QUEUE"], messages)
+
+        # Forget about any claims that no longer have messages we care about
+        active = self._active_claims()
+        for claim in list(self.claims):
+            if claim not in active:
+                del self.claims[claim]
+
+    def renew(self):
+        # Keep extending our claims on anything still in flight, otherwise a
+        # long running render would get handed out to another worker.
+        for claim, renewed in list(self.claims.items()):
+            if time.time() - renewed >= self.ttl / 2:
+                self.client.renew(
+                    self.config["QUEUE"],
+                    {"claim": claim},
+                    ttl=self.ttl,
+                )
+                self.claims[claim] = time.time()
+
+    def wait(self, timeout):
+        # Wait for a job to finish, but never so long that our claims lapse
+        timeout = min(timeout, self.ttl / 4)
+
+        running = [f for f in self.jobs if not f.done()]
+        if running:
+            concurrent.futures.wait(
+                running,
+                timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+        else:
+            time.sleep(timeout)
+
+    def release(self):
+        # Don't start any job that hasn't already, and let the ones that have
+        # finish before we hand anything back. Otherwise another worker could
+        # pick up a revision that we're still rendering.
+        for future in self.jobs:
+            future.cancel()
+
+        while any(not f.done() for f in self.jobs):
+            self.renew()
+            self.wait(self.ttl)
+
+        self.executor.shutdown(wait=True)
+
+        # Anything that has finished doesn't need to be done again
+        for future, (_, messages) in list(self.jobs.items()):
+            if future.cancelled() or future.exception() is not None:
+                continue
+
+            del self.jobs[future]
+            self.client.delete_many(self.config["QUEUE"], messages)
+
+        # Hand everything else back to the queue
+        for claim in self._active_claims():
+            self.client.unclaim(self.config["QUEUE"], {"claim": claim})
+
+        self.claims = {}
+
+    def run(self):
+        # Do Our Busy Loop
+        while True:
+            self.reap()
+            self.renew()
+
+            if self.full:
+                # Wait for a job to finish before claiming anything else
+                self.start()
+                self.wait(self.ttl)
+                continue
+
+            # grab a batch of Tasks from the queue
+            claimed = self.claim()
+
+            self.start()
+
+            if claimed:
+                # Keep claiming straight away for as long as there is work
+                self.backoff.reset()
+            else:
+                # If there were no tasks, wait a little longer each time
+                # before trying again
+                self.wait(self.backoff.delay())
+
+    def _active_claims(self):
+        messages = [m for _, m in self.jobs.values()]
+        messages.extend(self.pending.values())
+
+        return {task["claim"] for batch in messages for task in batch}
+
+
 def main(args):
     # Get our configuration
     config = {
@@ -27,65 +257,55 @@ def main(args):
         if k.upper().startswith("CONVERGE_")
     }
 
-    task = None
+    parser = argparse.ArgumentParser(prog="converge.worker")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=int(config.get("BATCH_SIZE", 10)),
+        help="How many messages to claim from the queue at once",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(config.get("CONCURRENCY", 1)),
+        help="How many revisions to process at once",
+    )
+    args = parser.parse_args(args)
 
-    try:
-        # Do Our Busy Loop
-        while True:
-            # grab a Task from the queue
-            task = queue.claim(
-                config["RACKSPACE_USER"],
-                config["RACKSPACE_APIKEY"],
-                config["QUEUE"],
-                region=config["RACKSPACE_REGION"],
-            )
+    # Make sure we can see what our jobs are reporting
+    logging.basicConfig(
+        level=config.get("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
 
-            if task is not None:
-                # Do Our Task
-                if task["body"]["event"] == "revision.process":
-                    tasks.process_revision(config, task["body"]["revision"])
-                else:
-                    raise ValueError(
-                        "Unknown event '{}'".format(task["body"]["event"])
-                    )
-
-                # Delete the task now that it's been processed
-                queue.delete(
-                    config["RACKSPACE_USER"],
-                    config["RACKSPACE_APIKEY"],
-                    config["QUEUE"],
-                    task,
-                    region=config["RACKSPACE_REGION"],
-                )
+    worker = Worker(
+        config,
+        queue.get_client(
+            config["RACKSPACE_USER"],
+            config["RACKSPACE_APIKEY"],
+            region=config["RACKSPACE_REGION"],
+        ),
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        ttl=int(config.get("CLAIM_TTL", 300)),
+        backoff=Backoff(
+            minimum=float(config.get("POLL_MIN", 1)),
+            maximum=float(config.get("POLL_MAX", 30)),
+        ),
+    )
 
-                task = None
-            else:
-                # If there were no tasks, wait for 5 seconds and try again
-                time.sleep(5)
+    try:
+        worker.run()
     except KeyboardInterrupt:
         print("Exiting converge.worker...")
 
         # Release any claims we have as we are shutting down
-        if task is not None:
-            queue.unclaim(
-                config["RACKSPACE_USER"],
-                config["RACKSPACE_APIKEY"],
-                config["QUEUE"],
-                task,
-                region=config["RACKSPACE_REGION"],
-            )
+        worker.release()
 
         return
     except:
         # Release any claims we have as we hit an error
-        if task is not None:
-            queue.unclaim(
-                config["RACKSPACE_USER"],
-                config["RACKSPACE_APIKEY"],
-                config["QUEUE"],
-                task,
-                region=config["RACKSPACE_REGION"],
-            )
+        worker.release()
 
         raise
 
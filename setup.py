@@ -49,15 +49,22 @@ setuptools.setup(
         "Operating System :: POSIX :: Linux",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
     ],
 
     packages=setuptools.find_packages(exclude=["tests", "tests.*"]),
 
+    # We share auth tokens between drivers with ex_auth_cache, which needs
+    # libcloud 3.4+. Reports rely on coverage 3.x's data and HTML reporter
+    # internals, which coverage 4 replaced, and coverage 3.x doesn't run on
+    # Python 3.8+.
+    python_requires=">=3.5, <3.8",
+
     install_requires=[
-        "apache-libcloud",
-        "coverage",
+        "apache-libcloud>=3.4.0",
+        "coverage>=3.7,<4",
         "Flask",
         "requests",
     ],
@@ -0,0 +1,231 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import threading
+
+import pytest
+
+from converge.cache import DiskCache, TreeCache
+
+
+def _fetcher(data, metadata=None, calls=None):
+    def fetch(fp):
+        if calls is not None:
+            calls.append(data)
+        fp.write(data)
+        return metadata
+    return fetch
+
+
+def _get(cache, key, fetch):
+    fp, metadata = cache.get(key, fetch)
+    with fp:
+        return fp.read(), metadata
+
+
+class TestDiskCache:
+
+    def test_miss_then_hit(self, tmpdir):
+        cache = DiskCache(str(tmpdir), 100)
+        calls = []
+
+        assert _get(cache, "a", _fetcher(b"aaa", {"x": 1}, calls)) == (
+            b"aaa", {"x": 1},
+        )
+        assert _get(cache, "a", _fetcher(b"bbb", {"x": 2}, calls)) == (
+            b"aaa", {"x": 1},
+        )
+        assert calls == [b"aaa"]
+
+    def test_single_flight(self, tmpdir):
+        cache = DiskCache(str(tmpdir), 100)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def fetch(fp):
+            calls.append(None)
+            started.set()
+            release.wait()
+            fp.write(b"data")
+            return {}
+
+        results = []
+
+        def get():
+            results.append(_get(cache, "a", fetch))
+
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert results == [(b"data", {})] * 5
+
+    def test_failed_fetch(self, tmpdir):
+        cache = DiskCache(str(tmpdir), 100)
+
+        def fetch(fp):
+            fp.write(b"partial")
+            raise OSError("connection reset")
+
+        with pytest.raises(OSError):
+            cache.get("a", fetch)
+
+        assert tmpdir.listdir() == []
+        assert _get(cache, "a", _fetcher(b"aaa")) == (b"aaa", None)
+
+    def test_evicts_least_recently_used(self, tmpdir):
+        cache = DiskCache(str(tmpdir), 10)
+        calls = []
+
+        _get(cache, "a", _fetcher(b"aaaa", calls=calls))
+        _get(cache, "b", _fetcher(b"bbbb", calls=calls))
+        _get(cache, "a", _fetcher(b"aaaa", calls=calls))
+        _get(cache, "c", _fetcher(b"cccc", calls=calls))
+
+        assert calls == [b"aaaa", b"bbbb", b"cccc"]
+        assert len(tmpdir.listdir()) == 4
+
+        _get(cache, "a", _fetcher(b"aaaa", calls=calls))
+        _get(cache, "b", _fetcher(b"bbbb", calls=calls))
+
+        assert calls == [b"aaaa", b"bbbb", b"cccc", b"bbbb"]
+
+    def test_serves_entries_too_large_to_keep(self, tmpdir):
+        cache = DiskCache(str(tmpdir), 2)
+
+        assert _get(cache, "a", _fetcher(b"aaaa")) == (b"aaaa", None)
+        assert tmpdir.listdir() == []
+
+    def test_reloads_after_restart(self, tmpdir):
+        cache = DiskCache(str(tmpdir), 10)
+        _get(cache, "a", _fetcher(b"aaaa", {"x": 1}))
+        _get(cache, "b", _fetcher(b"bbbb", {"x": 2}))
+
+        # Make a the most recently used, as if it had been read last
+        os.utime(cache._path("a"), (2000000000, 2000000000))
+
+        # Leftovers from a fetch that never finished
+        tmpdir.join("partial.tmp").write_binary(b"x")
+        tmpdir.join("partial.tmp.json").write_binary(b"x")
+
+        cache = DiskCache(str(tmpdir), 10)
+        calls = []
+
+        assert not tmpdir.join("partial.tmp").check()
+        assert not tmpdir.join("partial.tmp.json").check()
+        assert _get(cache, "b", _fetcher(b"", calls=calls)) == (
+            b"bbbb", {"x": 2},
+        )
+        assert _get(cache, "a", _fetcher(b"", calls=calls)) == (
+            b"aaaa", {"x": 1},
+        )
+        assert calls == []
+
+    def test_reload_evicts_down_to_size(self, tmpdir):
+        cache = DiskCache(str(tmpdir), 10)
+        _get(cache, "a", _fetcher(b"aaaa"))
+        _get(cache, "b", _fetcher(b"bbbb"))
+        os.utime(cache._path("a"), (1000000000, 1000000000))
+
+        cache = DiskCache(str(tmpdir), 5)
+        calls = []
+
+        _get(cache, "b", _fetcher(b"bbbb", calls=calls))
+        assert calls == []
+        _get(cache, "a", _fetcher(b"aaaa", calls=calls))
+        assert calls == [b"aaaa"]
+
+
+def _fill(path, name, size):
+    with open(os.path.join(path, name), "wb") as fp:
+        fp.write(b"x" * size)
+
+
+class TestTreeCache:
+
+    def test_keeps_trees(self, tmpdir):
+        cache = TreeCache(str(tmpdir), 100)
+
+        with cache.tree("a") as path:
+            _fill(path, "module.py", 10)
+
+        with cache.tree("a") as path:
+            assert os.listdir(path) == ["module.py"]
+
+        with cache.tree("b") as path:
+            assert os.listdir(path) == []
+
+    def test_evicts_least_recently_used(self, tmpdir):
+        cache = TreeCache(str(tmpdir), 25)
+
+        with cache.tree("a") as path:
+            _fill(path, "module.py", 10)
+        with cache.tree("b") as path:
+            _fill(path, "module.py", 10)
+        with cache.tree("a"):
+            pass
+        with cache.tree("c") as path:
+            _fill(path, "module.py", 10)
+
+        with cache.tree("a") as path:
+            assert os.listdir(path) == ["module.py"]
+        with cache.tree("b") as path:
+            assert os.listdir(path) == []
+
+    def test_does_not_evict_pinned_trees(self, tmpdir):
+        cache = TreeCache(str(tmpdir), 15)
+        with cache.tree("a") as a:
+            _fill(a, "module.py", 10)
+
+        with cache.tree("a"):
+            with cache.tree("b") as path:
+                _fill(path, "module.py", 10)
+
+            # a is in use, so b has to go instead even though it is newer
+            assert os.listdir(a) == ["module.py"]
+
+        with cache.tree("b") as path:
+            assert os.listdir(path) == []
+
+    def test_evicts_trees_too_large_to_keep(self, tmpdir):
+        cache = TreeCache(str(tmpdir), 15)
+
+        with cache.tree("a") as a:
+            _fill(a, "module.py", 20)
+
+        assert not os.path.exists(a)
+
+    def test_reloads_after_restart(self, tmpdir):
+        cache = TreeCache(str(tmpdir), 25)
+        with cache.tree("a") as a:
+            _fill(a, "module.py", 10)
+        with cache.tree("b") as b:
+            _fill(b, "module.py", 10)
+
+        # Make a the most recently used, as if it had been read last
+        os.utime(a, (2000000000, 2000000000))
+
+        cache = TreeCache(str(tmpdir), 25)
+        with cache.tree("c") as path:
+            _fill(path, "module.py", 10)
+
+        assert os.listdir(a) == ["module.py"]
+        assert not os.path.exists(b)
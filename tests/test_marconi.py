@@ -0,0 +1,125 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+
+import pytest
+
+from converge import marconi
+
+
+@pytest.mark.parametrize(("value", "expected"), [
+    ("2014-04-01T12:00:00Z", 1396353600),
+    ("2014-04-01T12:00:00.123Z", 1396353600),
+    ("2014-04-01T12:00:00", 1396353600),
+    ("2014-04-01T12:00:00+00:00", 1396353600),
+    ("2014-04-01T12:00:00.000-05:00", 1396353600 + 5 * 3600),
+    ("2014-04-01T12:00:00+0530", 1396353600 - 5 * 3600 - 30 * 60),
+])
+def test_parse_expires(value, expected):
+    assert marconi._parse_expires(value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    "",
+    "tomorrow",
+    "2014-04-01",
+    "2014-04-01T12:00:00+5",
+    "2014-04-01T12:00:00Z junk",
+])
+def test_parse_expires_invalid(value):
+    with pytest.raises(ValueError):
+        marconi._parse_expires(value)
+
+
+class FakeResponse:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+@pytest.fixture
+def tokens(monkeypatch):
+    monkeypatch.setattr(marconi, "_tokens", {})
+
+    issued = []
+
+    def authenticate(user, key):
+        issued.append("token-{}".format(len(issued)))
+        return issued[-1], time.time() + 3600
+
+    monkeypatch.setattr(marconi, "_authenticate", authenticate)
+    return issued
+
+
+def _client(statuses):
+    client = marconi.QueueClient("user", "key")
+    sent = []
+
+    def request(method, url, headers, **kwargs):
+        sent.append(headers["X-Auth-Token"])
+        return FakeResponse(statuses.pop(0))
+
+    client.session.request = request
+    return client, sent
+
+
+def test_reuses_token(tokens):
+    client, sent = _client([200, 200])
+
+    client._request("GET", "v1/queues/q/stats")
+    client._request("GET", "v1/queues/q/stats")
+
+    assert tokens == ["token-0"]
+    assert sent == ["token-0", "token-0"]
+
+
+def test_refreshes_expiring_token(tokens, monkeypatch):
+    client, sent = _client([200, 200])
+
+    client._request("GET", "v1/queues/q/stats")
+    monkeypatch.setattr(
+        time,
+        "time",
+        lambda: marconi._tokens[("user", "key")][1] - 1,
+    )
+    client._request("GET", "v1/queues/q/stats")
+
+    assert sent == ["token-0", "token-1"]
+
+
+def test_retries_rejected_token(tokens):
+    client, sent = _client([401, 200])
+
+    resp = client._request("GET", "v1/queues/q/stats")
+
+    assert resp.status_code == 200
+    assert sent == ["token-0", "token-1"]
+    assert marconi._tokens[("user", "key")][0] == "token-1"
+
+
+def test_only_retries_once(tokens):
+    client, sent = _client([401, 401])
+
+    resp = client._request("GET", "v1/queues/q/stats")
+
+    assert resp.status_code == 401
+    assert sent == ["token-0", "token-1"]
+
+
+def test_keeps_token_replaced_by_another_thread(tokens):
+    marconi._tokens[("user", "key")] = ("token-new", time.time() + 3600)
+
+    marconi._invalidate_auth_token("user", "key", "token-old")
+
+    assert marconi._tokens[("user", "key")][0] == "token-new"
@@ -0,0 +1,60 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+
+from converge.merge import CoverageAccumulator
+
+
+class TestCoverageAccumulator:
+
+    def test_add_merges(self):
+        accumulator = CoverageAccumulator()
+        accumulator.add({
+            "lines": {"a.py": [3, 1, 2, 2]},
+            "arcs": {"a.py": [[1, 2], [-1, 1]]},
+        })
+        accumulator.add({
+            "lines": {"a.py": [5, 2], "b.py": [1]},
+            "arcs": {"a.py": [[1, 2], [2, -1]]},
+        })
+
+        assert accumulator.dump() == {
+            "lines": {"a.py": [1, 2, 3, 5], "b.py": [1]},
+            "arcs": {"a.py": [[-1, 1], [1, 2], [2, -1]]},
+        }
+        assert accumulator.paths() == {"a.py", "b.py"}
+
+    def test_dump_round_trips(self):
+        accumulator = CoverageAccumulator()
+        accumulator.add({
+            "lines": {"a.py": [1, 2]},
+            "arcs": {"a.py": [[1, 2]]},
+        })
+
+        loaded = CoverageAccumulator()
+        loaded.add(accumulator.dump())
+
+        assert loaded.dump() == accumulator.dump()
+
+    @pytest.mark.parametrize("data", [
+        {"lines": {"a.py": [1, "x"]}},
+        {"arcs": {"a.py": [[1, 2, 3]]}},
+    ])
+    def test_add_invalid(self, data):
+        accumulator = CoverageAccumulator()
+
+        with pytest.raises((TypeError, ValueError)):
+            accumulator.add(data)
+
+        assert accumulator.dump() == {"lines": {}, "arcs": {}}
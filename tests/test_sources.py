@@ -0,0 +1,101 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import collections
+import os
+
+import pytest
+
+from converge import sources
+
+
+@pytest.mark.parametrize("filename", [
+    "setup.py",
+    "pkg/module.py",
+    "pkg/../module.py",
+    ".coveragerc",
+])
+def test_check_filename_allows(filename):
+    sources._check_filename(filename)
+
+
+@pytest.mark.parametrize("filename", [
+    "",
+    ".",
+    "..",
+    "../module.py",
+    "pkg/../../module.py",
+    "/etc/passwd",
+])
+def test_check_filename_rejects(filename):
+    with pytest.raises(ValueError):
+        sources._check_filename(filename)
+
+
+def test_write(tmpdir):
+    sources._write(str(tmpdir), "pkg/module.py", b"x = 1\n")
+
+    assert tmpdir.join("pkg", "module.py").read_binary() == b"x = 1\n"
+    assert tmpdir.join("pkg").listdir() == [tmpdir.join("pkg", "module.py")]
+
+
+def test_write_replaces(tmpdir):
+    tmpdir.join("module.py").write_binary(b"old\n")
+
+    sources._write(str(tmpdir), "module.py", b"new\n")
+
+    assert tmpdir.join("module.py").read_binary() == b"new\n"
+
+
+@pytest.mark.parametrize("filename", ["../module.py", "/tmp/module.py"])
+def test_write_rejects_escape(tmpdir, filename):
+    directory = tmpdir.mkdir("tree")
+
+    with pytest.raises(ValueError):
+        sources._write(str(directory), filename, b"x = 1\n")
+
+    assert tmpdir.listdir() == [directory]
+    assert directory.listdir() == []
+
+
+def test_write_rejects_symlink_escape(tmpdir):
+    directory = tmpdir.mkdir("tree")
+    outside = tmpdir.mkdir("outside")
+    os.symlink(str(outside), str(directory.join("link")))
+
+    with pytest.raises(ValueError):
+        sources._write(str(directory), "link/module.py", b"x = 1\n")
+
+    assert outside.listdir() == []
+
+
+def test_write_cleans_up_on_failure(tmpdir, monkeypatch):
+    def replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", replace)
+
+    with pytest.raises(OSError):
+        sources._write(str(tmpdir), "module.py", b"x = 1\n")
+
+    assert tmpdir.listdir() == []
+
+
+def test_known_is_bounded(monkeypatch):
+    monkeypatch.setattr(sources, "KNOWN_SIZE", 2)
+    monkeypatch.setattr(sources, "_known", collections.OrderedDict())
+
+    for name in ["a", "b", "c"]:
+        sources._remember(name)
+
+    assert list(sources._known) == ["b", "c"]
@@ -0,0 +1,94 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import io
+
+import pytest
+import requests
+
+from libcloud.storage.base import Container
+from libcloud.storage.providers import get_driver
+from libcloud.storage.types import Provider
+
+from converge.storage import upload_bytes, upload_chunks
+
+
+class FakeCloudFiles:
+    # Stands in for Cloud Files at the HTTP layer, so the real libcloud
+    # driver does everything it normally would with the request.
+
+    def __init__(self):
+        self.objects = {}
+
+    def send(self, adapter, request, **kwargs):
+        body = request.body
+        if hasattr(body, "read"):
+            data = body.read()
+        elif body is None or isinstance(body, bytes):
+            data = body or b""
+        else:
+            data = b"".join(body)
+
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.raw = io.BytesIO(b"")
+
+        if request.method == "PUT":
+            name = request.path_url.split("?")[0].rsplit("/", 1)[-1]
+            self.objects[name] = data
+            response.status_code = 201
+            response.headers["ETag"] = hashlib.md5(data).hexdigest()
+        else:
+            response.status_code = 404
+
+        return response
+
+
+@pytest.fixture
+def cloudfiles(monkeypatch):
+    fake = FakeCloudFiles()
+    monkeypatch.setattr(
+        "requests.adapters.HTTPAdapter.send",
+        lambda adapter, request, **kw: fake.send(adapter, request, **kw),
+    )
+    return fake
+
+
+@pytest.fixture
+def container(cloudfiles):
+    driver = get_driver(Provider.CLOUDFILES)(
+        "user",
+        "key",
+        region="iad",
+        ex_force_auth_token="token",
+        ex_force_base_url="https://storage.example.com/v1/account",
+    )
+    return Container("bucket", None, driver)
+
+
+def test_upload_bytes(cloudfiles, container):
+    obj = upload_bytes(container, b"hello world", "thing")
+
+    assert cloudfiles.objects == {"thing": b"hello world"}
+    assert obj.hash == hashlib.md5(b"hello world").hexdigest()
+
+
+def test_upload_chunks(cloudfiles, container):
+    chunks = (c for c in [b"hello ", b"", b"world"])
+
+    obj = upload_chunks(container, chunks, "thing")
+
+    assert cloudfiles.objects == {"thing": b"hello world"}
+    assert obj.hash == hashlib.md5(b"hello world").hexdigest()
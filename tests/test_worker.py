@@ -0,0 +1,148 @@
+# Copyright 2014 Donald Stufft
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+
+import pytest
+
+from converge.worker import Backoff, Worker
+
+
+class TestBackoff:
+
+    def test_delay_grows(self, monkeypatch):
+        monkeypatch.setattr("random.uniform", lambda a, b: b)
+        backoff = Backoff(minimum=1, maximum=30)
+
+        assert [backoff.delay() for _ in range(7)] == [1, 2, 4, 8, 16, 30, 30]
+
+    def test_delay_within_bounds(self):
+        backoff = Backoff(minimum=1, maximum=30)
+
+        for _ in range(50):
+            assert 1 <= backoff.delay() <= 30
+
+    def test_delay_stops_counting_at_maximum(self):
+        backoff = Backoff(minimum=1, maximum=30)
+
+        for _ in range(5000):
+            backoff.delay()
+
+        assert backoff.attempts == 5
+        assert backoff.delay() <= 30
+
+    def test_zero_minimum_grows(self, monkeypatch):
+        monkeypatch.setattr("random.uniform", lambda a, b: b)
+        backoff = Backoff(minimum=0, maximum=30)
+
+        assert [backoff.delay() for _ in range(7)] == [1, 2, 4, 8, 16, 30, 30]
+
+    def test_zero_minimum_stops_counting_at_maximum(self):
+        backoff = Backoff(minimum=0, maximum=30)
+
+        for _ in range(5000):
+            assert 0 <= backoff.delay() <= 30
+
+        assert backoff.attempts == 5
+
+    def test_reset(self, monkeypatch):
+        monkeypatch.setattr("random.uniform", lambda a, b: b)
+        backoff = Backoff(minimum=1, maximum=30)
+        backoff.delay()
+        backoff.delay()
+
+        backoff.reset()
+
+        assert backoff.attempts == 0
+        assert backoff.delay() == 1
+
+    @pytest.mark.parametrize(("minimum", "maximum"), [(5, 5), (10, 1)])
+    def test_maximum_not_above_minimum(self, minimum, maximum):
+        backoff = Backoff(minimum=minimum, maximum=maximum)
+
+        for _ in range(3):
+            assert backoff.delay() == minimum
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.deleted = []
+        self.unclaimed = []
+
+    def delete_many(self, queue, tasks):
+        self.deleted.extend(tasks)
+
+    def renew(self, queue, task, ttl):
+        pass
+
+    def unclaim(self, queue, task):
+        self.unclaimed.append(task["claim"])
+
+
+def _message(revision, claim):
+    return {
+        "claim": claim,
+        "body": {"event": "revision.process", "revision": revision},
+    }
+
+
+class TestWorker:
+
+    def test_reap_failed_job(self, monkeypatch):
+        def process(config, revision, messages):
+            if revision == "bad":
+                raise ValueError("Broken")
+
+        monkeypatch.setattr("converge.worker.process", process)
+
+        client = FakeClient()
+        worker = Worker({"QUEUE": "q"}, client, concurrency=2)
+        good, bad = _message("good", "c1"), _message("bad", "c2")
+        worker.claims = {"c1": 0, "c2": 0}
+        worker.pending.update({"good": [good], "bad": [bad]})
+
+        worker.start()
+        worker.executor.shutdown(wait=True)
+        worker.reap()
+
+        # Only the good job's messages are deleted, and we stop renewing the
+        # bad job's claim so that its messages go back to the queue.
+        assert client.deleted == [good]
+        assert worker.jobs == {}
+        assert worker.claims == {}
+
+    def test_release_waits_for_running_jobs(self, monkeypatch):
+        started, finish = threading.Event(), threading.Event()
+
+        def process(config, revision, messages):
+            started.set()
+            finish.wait()
+
+        monkeypatch.setattr("converge.worker.process", process)
+
+        client = FakeClient()
+        worker = Worker({"QUEUE": "q"}, client, concurrency=1)
+        running, waiting = _message("one", "c1"), _message("two", "c2")
+        worker.claims = {"c1": 0, "c2": 0}
+        worker.pending.update({"one": [running], "two": [waiting]})
+
+        worker.start()
+        started.wait()
+        threading.Timer(0.1, finish.set).start()
+        worker.release()
+
+        # The running job got to finish before anything was handed back, and
+        # only what never ran is returned to the queue.
+        assert client.deleted == [running]
+        assert client.unclaimed == ["c2"]